@@ -17,15 +17,16 @@ def heredoc(astring: str) -> str:
     a text file using this so a trailing newline is nearly always what
     you want.
     """
-    lines = astring.splitlines(keepends=True)
-    first_line = lines[0]
-    content_lines = lines[1:-1]
-    last_line = lines[-1]
-    assert first_line.isspace(), 'first line must be all whitespace'
-    assert last_line.isspace(), 'last line must be all whitespace'
-    indentation_template = last_line.rstrip('\n')
-    assert all(l.startswith(indentation_template) for l in content_lines), \
-        'all content lines must begin with same whitespace as last one'
-    unindented_lines = \
-        [l.removeprefix(indentation_template) for l in content_lines]
-    return ''.join(unindented_lines)
\ No newline at end of file
+    first_newline = astring.index('\n')
+    last_newline = astring.rindex('\n')
+    indentation_template = astring[last_newline + 1:]
+    body = astring[first_newline:last_newline + 1]
+    if __debug__:
+        assert astring[:first_newline + 1].isspace(), \
+            'first line must be all whitespace'
+        assert indentation_template.isspace(), \
+            'last line must be all whitespace'
+        assert body.count('\n' + indentation_template) \
+            == body.count('\n') - 1, \
+            'all content lines must begin with same whitespace as last one'
+    return body.replace('\n' + indentation_template, '\n')[1:]
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
-from subprocess import run, DEVNULL
+from functools import cache
+from pathlib import Path
+from subprocess import run
 from socket import gethostname
 import sys
-from typing import AbstractSet, Iterable, Set, TypeAlias
+from tempfile import TemporaryDirectory
+from types import MappingProxyType
+from typing import AbstractSet, Iterable, Mapping, Set, TypeAlias
 
 from heredocs import heredoc
 
@@ -15,16 +19,18 @@ PackageName: TypeAlias = str
 RepoTag: TypeAlias = str
 Role: TypeAlias = str
 
+_EMPTY: frozenset = frozenset()
+
 
 def yumrepo(name, filestem, baseurl, gpg_key_url):
-    repofile = heredoc(f"""
-        [code]
-        name={name}
-        baseurl={baseurl}
-        enabled=1
-        gpgcheck=1
-        gpgkey={gpg_key_url}
-        """)
+    repofile = (
+        "[code]\n"
+        f"name={name}\n"
+        f"baseurl={baseurl}\n"
+        "enabled=1\n"
+        "gpgcheck=1\n"
+        f"gpgkey={gpg_key_url}\n"
+    )
     return {
         'repofile': repofile,
         'file_stem': filestem,
@@ -47,21 +53,21 @@ machine_roles: dict[Hostname, set[Role]] = {
     },
 }
 
-dnf_repos: dict[RepoTag, dict] = {
+dnf_repos: Mapping[RepoTag, dict] = MappingProxyType({
     'vscode': yumrepo(
         name='Visual Studio Code',
         filestem='vscode',
         baseurl='https://packages.microsoft.com/yumrepos/vscode',
         gpg_key_url='https://packages.microsoft.com/keys/microsoft.asc',
     ),
-}
+})
 
-package_dnf_repos: dict[PackageName, set[RepoTag]] = {
+package_dnf_repos: Mapping[PackageName, set[RepoTag]] = MappingProxyType({
     # singletons for flattening
     'code': {'vscode'},
-}
+})
 
-flatpaks: dict[Role, Set[FlatpakName]] = {
+flatpaks: Mapping[Role, Set[FlatpakName]] = MappingProxyType({
     'common': {
         'com.github.tchx84.Flatseal',
     },
@@ -73,13 +79,13 @@ flatpaks: dict[Role, Set[FlatpakName]] = {
             # ^ for PWAs (as first choice if works)
             # ^ and for Jitsi meetings (due to Chromium engine)
     },
-}
+})
 
 gnome_extensions: dict[Role, frozenset[GnomeExtension]] = {
     'gnome': frozenset(),
 }
 
-roles: dict[Role, frozenset[PackageName]] = {
+roles: Mapping[Role, frozenset[PackageName]] = MappingProxyType({
     'common': frozenset({
         'firewall-config',
         'htop',
@@ -156,17 +162,36 @@ roles: dict[Role, frozenset[PackageName]] = {
         'wireguard-tools', # VPN
         'xournalpp',
     }),
-}
+})
 
-dependent_packages: dict[PackageName, Set[Role]] = {
+dependent_packages: Mapping[PackageName, Set[Role]] = MappingProxyType({
     # install package on the left if all the roles on the right
     # are requested
     'nextcloud-client-nautilus': {'gnome', 'work'},
-}
+})
+
+
+def _index_dependent_packages() \
+        -> dict[Role, list[tuple[PackageName, frozenset[Role]]]]:
+    # dependent_packages keyed by each role they mention, so a lookup only
+    # has to consider entries that could possibly match
+    index: dict[Role, list[tuple[PackageName, frozenset[Role]]]] = {}
+    for package_name, required_roles in dependent_packages.items():
+        for rolename in required_roles:
+            index.setdefault(rolename, []).append(
+                (package_name, frozenset(required_roles))
+            )
+    return index
+
+
+_dep_by_role = _index_dependent_packages()
 
 
 def union(sets: Iterable[AbstractSet]) -> frozenset:
-    return frozenset().union(*sets)
+    out: set = set()
+    for s in sets:
+        out.update(s)
+    return frozenset(out)
 
 
 def dnf(packages: Iterable[PackageName]) -> None:
@@ -199,29 +224,38 @@ def install_flatpaks_from_flathub(required_flatpaks: Iterable[FlatpakName]) \
         )
 
 
-def install_repo(repo: dict) -> None:
-    run(['sudo', 'rpm', '--import', repo['import_gpg_key']], check=True)
-    run(
-        ['sudo', 'tee', f"/etc/yum.repos.d/{repo['file_stem']}.repo"],
-        input=repo['repofile'],
-        stdout=DEVNULL,
-        encoding='utf8',
-        check=True,
-    )
-    ret = run(['sudo', 'dnf', 'check-update'])
-    if ret.returncode == 100:
-        # I think 100 means "there are updates" and this isn't
-        # necessarily fatal
-        pass
-    else:
-        ret.check_returncode()
+def stage_repo(repo: dict, staging_dir: Path) -> Path:
+    repo_path = staging_dir / f"{repo['file_stem']}.repo"
+    repo_path.write_text(repo['repofile'], encoding='utf8')
+    return repo_path
+
+
+def commit_repos(repos: Iterable[dict]) -> None:
+    # One rpm --import and one install for all the repos.  The metadata
+    # for the new repos gets fetched by the dnf install that follows.
+    repos = list(repos)
+    if repos:
+        gpg_keys = sorted({repo['import_gpg_key'] for repo in repos})
+        run(['sudo', 'rpm', '--import', *gpg_keys], check=True)
+        with TemporaryDirectory() as staging_dir:
+            repo_paths = \
+                [stage_repo(repo, Path(staging_dir)) for repo in repos]
+            run(
+                [
+                    'sudo', 'install',
+                        '--mode=644',
+                        '--target-directory=/etc/yum.repos.d',
+                        *repo_paths,
+                ],
+                check=True,
+            )
 
 
 def extra_repos_for_packages(required_packages: Iterable[PackageName]) \
         -> list[dict]:
     extra_repo_names: frozenset[RepoTag] = \
         union(
-            package_dnf_repos.get(pkgname, set())
+            package_dnf_repos.get(pkgname, _EMPTY)
             for pkgname in required_packages
         )
     return [dnf_repos[reponame] for reponame in extra_repo_names]
@@ -230,7 +264,7 @@ def extra_repos_for_packages(required_packages: Iterable[PackageName]) \
 def flatpaks_for_individual_roles(requested_roles: AbstractSet[Role]) \
         -> frozenset[FlatpakName]:
     return union(
-        flatpaks.get(rolename, frozenset())
+        flatpaks.get(rolename, _EMPTY)
         for rolename in requested_roles
     )
 
@@ -242,23 +276,52 @@ def packages_for_individual_roles(requested_roles: AbstractSet[Role]) \
 
 def packages_for_role_combinations(requested_roles: AbstractSet[Role]) \
         -> frozenset[PackageName]:
+    req = requested_roles \
+        if isinstance(requested_roles, (set, frozenset)) \
+        else frozenset(requested_roles)
     extra_packages: set[PackageName] = set()
-    for package_name, required_roles in dependent_packages.items():
-        if required_roles <= set(requested_roles):
-            extra_packages.add(package_name)
+    seen: set[PackageName] = set()
+    for rolename in req:
+        for package_name, required_roles in _dep_by_role.get(rolename, ()):
+            if package_name in seen:
+                continue
+            seen.add(package_name)
+            if required_roles <= req:
+                extra_packages.add(package_name)
     return frozenset(extra_packages)
 
 
 def packages_for_roles(requested_roles: AbstractSet[Role]) \
         -> frozenset[PackageName]:
+    return _packages_for_roles(frozenset(requested_roles))
+
+
+@cache
+def _packages_for_roles(requested_roles: frozenset[Role]) \
+        -> frozenset[PackageName]:
     return(
         packages_for_individual_roles(requested_roles)
         | packages_for_role_combinations(requested_roles)
     )
 
 
+# Everything main() needs to know for each declared machine, worked out
+# once at import since machine_roles is fixed
+_PRECOMPUTED: dict[
+    Hostname,
+    tuple[frozenset[PackageName], frozenset[FlatpakName], tuple[dict, ...]],
+] = {
+    hostname: (
+        packages_for_roles(requested_roles),
+        flatpaks_for_individual_roles(requested_roles),
+        tuple(extra_repos_for_packages(packages_for_roles(requested_roles))),
+    )
+    for hostname, requested_roles in machine_roles.items()
+}
+
+
 def main() -> None:
-    machine_name = gethostname().split('.')[0]
+    machine_name = gethostname().partition('.')[0]
     if machine_name not in machine_roles:
         sys.stderr.write(heredoc(f"""
             Hostname {machine_name} not declared in machine_roles
@@ -269,15 +332,11 @@ def main() -> None:
             """))
         sys.exit(4)
     else:
-        requested_roles = machine_roles[machine_name]
-        required_packages = packages_for_roles(requested_roles)
-        extra_repos = extra_repos_for_packages(required_packages)
-        for repo in extra_repos:
-            install_repo(repo)
+        required_packages, required_flatpaks, extra_repos = \
+            _PRECOMPUTED[machine_name]
+        commit_repos(extra_repos)
         dnf(required_packages)
         enable_flathub()
-        required_flatpaks =\
-            flatpaks_for_individual_roles(requested_roles)
         install_flatpaks_from_flathub(required_flatpaks)
 
 